@@ -0,0 +1,235 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Scanning of source text for Trojan Source characters."""
+
+from __future__ import annotations
+
+import re
+from typing import Iterator, Tuple
+
+import lsprotocol.types as lsp
+
+# Source reported on diagnostics, the tool module run by the server.
+DIAGNOSTIC_SOURCE = "unisource"
+
+# Unicode character dictionary declarations for searching
+
+# Bidirectional Unicode Characters
+BIDI_UNICODE_CHARS = {
+    "\u202a": "LRE",
+    "\u202b": "RLE",
+    "\u202d": "LRO",
+    "\u202e": "RLO",
+    "\u2066": "LRI",
+    "\u2067": "RLI",
+    "\u2068": "FSI",
+    "\u202c": "PDF",
+    "\u2069": "PDI",
+}
+
+# Inivsible Unicode Characters
+INVISIBLE_UNICODE_CHARS = {
+    "\u200b": "Zero-Width Space ZWSP)",
+    "\u200c": "Zero-Width Non-Joiner (ZWNJ)",
+    "\u200d": "Zero-Width Joiner (ZWJ)",
+    "\ufeff": "Zero-Width Non-Breaking Space (ZWNBSP)",
+    "\u00ad": "Soft Hyphen (SHY)",
+    "\u200e": "Left-To-Right Mark (LTRM)",
+    "\u200f": "Right-To-Left Mark (RTLM)",
+    "\u2060": "Word Joiner (WJ)",
+    "\u2061": "Function Application (FAP)",
+    "\u2063": "Invisible Separator (IS)",
+    "\u2064": "Invisible Plus (IP)",
+    "\u2062": "Invisible Times (IT)",
+}
+
+# Homoglyphic Unicode Characters
+HOMOGLYPH_UNICODE_CHARS = {
+    # Greek Alphabet
+    "\u037f": "Greek Capital Letter Yot",
+    "\u0391": "Greek Capital Letter Alpha",
+    "\u0392": "Greek Capital Letter Beta",
+    "\u0395": "Greek Capital Letter Epsilon",
+    "\u0396": "Greek Capital Letter Zeta",
+    "\u0397": "Greek Capital Letter Eta",
+    "\u0399": "Greek Capital Letter Iota",
+    "\u039a": "Greek Capital Letter Kappa",
+    "\u039c": "Greek Capital Letter Mu",
+    "\u039d": "Greek Capital Letter Nu",
+    "\u039f": "Greek Capital Letter Omicron",
+    "\u03a1": "Greek Capital Letter Rho",
+    "\u03a4": "Greek Capital Letter Tau",
+    "\u03a5": "Greek Capital Letter Upsilon",
+    "\u03a7": "Greek Capital Letter Chi",
+    "\u03f2": "Greek Lunate Sigma Symbol",
+    "\u03f3": "Greek Letter Yot",
+    "\u03f9": "Greek Capital Lunate Sigma Symbol",
+    # Cyrillic Alphabet
+    "\u0405": "Cyrillic Capital Letter Dze",
+    "\u0406": "Cyrillic Capital Letter Byelorussian-Ukrainian I",
+    "\u0408": "Cyrillic Capital Letter Je",
+    "\u0410": "Cyrillic Capital Letter A",
+    "\u0412": "Cyrillic Capital Letter Ve",
+    "\u0415": "Cyrillic Capital Letter Ie",
+    "\u0417": "Cyrillic Capital Letter Ze",
+    "\u041d": "Cyrillic Capital Letter En",
+    "\u041e": "Cyrillic Capital Letter O",
+    "\u0420": "Cyrillic Capital Letter Er",
+    "\u0421": "Cyrillic Capital Letter Es",
+    "\u0422": "Cyrillic Capital Letter Te",
+    "\u0425": "Cyrillic Capital Letter Ha",
+    "\u04ae": "Cyrillic Capital Letter Straight U",
+    "\u04c0": "Cyrillic Letter Palochka",
+    "\u04cf": "Cyrillic Small Letter Palochka",
+}
+
+# Kinds of suspect characters
+_BIDI = 1
+_INVISIBLE = 2
+_HOMOGLYPH = 3
+
+# Lookup table from every suspect character to its kind
+_SUSPECT_CHARS = {
+    **{char: _BIDI for char in BIDI_UNICODE_CHARS},
+    **{char: _INVISIBLE for char in INVISIBLE_UNICODE_CHARS},
+    **{char: _HOMOGLYPH for char in HOMOGLYPH_UNICODE_CHARS},
+}
+
+# Diagnostic messages for every character, built once at import.
+# Bidi characters have one message per context: (comment out, early return, other).
+_BIDI_MSGS = {
+    char: (
+        f"Trojan Source Comment Out Attack Detected.\nBidi Unicode Chracter {name} detected. An attacker has introduced a Bidirectional Unicode character to comment code and disturb logic.",
+        f"Trojan Source Early Return Attack Detected.\nBidi Unicode Character {name} detected. An attacker has introduced a Bidirectional Unicode character to return your code early.",
+        f"Bidi Unicode Character {name} detected.\nAn attacker as introduced a Bidirectional Unicode Character to disturb code logic.",
+    )
+    for char, name in BIDI_UNICODE_CHARS.items()
+}
+_INVISIBLE_MSGS = {
+    char: f"Trojan Source Invisible Attack Detected\nUnicode Character {name} detected. An attacker may be trying to disturb code logic."
+    for char, name in INVISIBLE_UNICODE_CHARS.items()
+}
+_HOMOGLYPH_MSGS = {
+    char: f"Trojan Source Homoglyph Attack Detected. \nHomoglyphic Unicode character {name} detected. An attacker as introduced a Homoglyph Unicode Character to disturb code logic."
+    for char, name in HOMOGLYPH_UNICODE_CHARS.items()
+}
+
+# Compiled character class matching any suspect character. A single class lets
+# the regex engine skip clean text without leaving C; one group per kind (to get
+# the kind from match.lastindex) makes the scan about ten times slower.
+_SUSPECT_RE = re.compile("[" + "".join(_SUSPECT_CHARS) + "]")
+
+# Line breaks recognised by str.splitlines(), which pygls uses to split documents
+_LINE_BREAK_RE = re.compile("\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]")
+# Those line breaks other than "\n" and "\r"
+_OTHER_LINE_BREAKS = "\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+
+
+def has_newline_breaks_only(text: str) -> bool:
+    """Returns True if every line break in the text is a line feed or CRLF."""
+    if any(char in text for char in _OTHER_LINE_BREAKS):
+        return False
+    return "\r" not in text or text.count("\r") == text.count("\r\n")
+
+
+# Severities resolved once instead of on every diagnostic
+_SEVERITY_ERROR = lsp.DiagnosticSeverity.Error.value
+_SEVERITY_WARNING = lsp.DiagnosticSeverity.Warning.value
+
+
+def _create_diagnostic(line_num: int, index: int, msg: str, severity: int) -> dict:
+    """Creates a diagnostic pointing at a single position
+
+    function builds the JSON shape of lsp.Diagnostic directly, so diagnostics can be
+    published without building and then serializing the lsprotocol objects
+    """
+    position = {"line": line_num, "character": index}
+    return {
+        "range": {"start": position, "end": position},
+        "message": msg,
+        "severity": severity,
+        "source": DIAGNOSTIC_SOURCE,
+    }
+
+
+def _bidi_msg_index(line: str) -> int:
+    """Identifies the type of Bidi attack based on the context in the line
+
+    function returns the index into the _BIDI_MSGS tuples
+    """
+    if "return" in line:
+        return 1
+    if "#" in line or "'''" in line:
+        return 0
+    return 2
+
+
+def _advance_lines(
+    text: str, start: int, end: int, line: Tuple[int, int], newline_only: bool
+) -> Tuple[int, int]:
+    """Moves the (line number, line start) pair past the line breaks from start to end"""
+    line_num, line_start = line
+    if newline_only:
+        line_breaks = text.count("\n", start, end)
+        if line_breaks:
+            return line_num + line_breaks, text.rfind("\n", start, end) + 1
+        return line
+    for line_break in _LINE_BREAK_RE.finditer(text, start, end):
+        line_num += 1
+        line_start = line_break.end()
+    return line_num, line_start
+
+
+def _line_end(text: str, index: int, newline_only: bool) -> int:
+    """Returns the offset of the line break ending the line at index"""
+    if newline_only:
+        line_end = text.find("\n", index)
+    else:
+        line_break = _LINE_BREAK_RE.search(text, index)
+        line_end = line_break.start() if line_break else -1
+    return len(text) if line_end == -1 else line_end
+
+
+def scan_text(text: str, first_line: int = 0) -> Iterator[dict]:
+    """Checks text for every character in the _SUSPECT_CHARS table in a single pass
+
+    function scans the whole text once, works out the line and column of each match
+    from the line breaks before it, and yields the diagnostic for its attack type
+    """
+    # None of the suspect characters are ASCII, and CPython answers isascii()
+    # from the string header without reading the characters.
+    if text.isascii():
+        return
+
+    # Lines are split like str.splitlines(). When "\n" is the only line break,
+    # str.count() and str.rfind() can find the lines without the regex.
+    newline_only = has_newline_breaks_only(text)
+    line_num, line_start = first_line, 0
+    scanned = 0
+    bidi_line = -1
+    bidi_msg_index = 2
+
+    # Iterate through each match of the character class in the text
+    for match in _SUSPECT_RE.finditer(text):
+        index = match.start()
+        line_num, line_start = _advance_lines(
+            text, scanned, index, (line_num, line_start), newline_only
+        )
+        scanned = index
+
+        char = match.group()
+        kind = _SUSPECT_CHARS[char]
+        if kind == _BIDI:
+            if bidi_line != line_num:
+                line_end = _line_end(text, index, newline_only)
+                bidi_line = line_num
+                bidi_msg_index = _bidi_msg_index(text[line_start:line_end])
+            msg = _BIDI_MSGS[char][bidi_msg_index]
+            severity = _SEVERITY_ERROR
+        elif kind == _INVISIBLE:
+            msg = _INVISIBLE_MSGS[char]
+            severity = _SEVERITY_WARNING
+        else:
+            msg = _HOMOGLYPH_MSGS[char]
+            severity = _SEVERITY_ERROR
+        yield _create_diagnostic(line_num, index - line_start, msg, severity)
@@ -1,17 +1,23 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 """Implementation of tool support over LSP."""
+
 from __future__ import annotations
 
-import copy
+import collections
+import dataclasses
+import functools
+import itertools
 import json
 import os
 import pathlib
 import re
 import sys
 import sysconfig
+import threading
+import time
 import traceback
-from typing import Any, Optional, Sequence, Callable, Dict, List, Union
+from typing import Any, Optional, Sequence, Callable, Dict, Iterator, List, Tuple, Union
 
 
 # **********************************************************
@@ -37,18 +43,29 @@ update_sys_path(
 # **********************************************************
 # pylint: disable=wrong-import-position,import-error
 import lsp_jsonrpc as jsonrpc
+import lsp_scanner as scanner
 import lsp_utils as utils
 import lsprotocol.types as lsp
 from pygls import server, uris, workspace
+from pygls.protocol import JsonRPCNotification
 
 WORKSPACE_SETTINGS = {}
 GLOBAL_SETTINGS = {}
+# Workspace folders of WORKSPACE_SETTINGS, rebuilt whenever it is updated.
+_WORKSPACES_FS: frozenset[str] = frozenset()
 RUNNER = pathlib.Path(__file__).parent / "lsp_runner.py"
 
+# The extension sets this to "off" when its output channel does not show logs,
+# so messages (and their formatting) can be skipped entirely. Later changes of the
+# log level arrive as $/setTrace notifications.
+_LOG_ENABLED = os.getenv("LS_ENABLE_LOG", "on") != "off"
+
 MAX_WORKERS = 5
 # TODO: Update the language server name and version.
 LSP_SERVER = server.LanguageServer(
-    name="TrojanSourceFinder", version="<server version>", max_workers=MAX_WORKERS
+    name="TrojanSourceFinder",
+    version="<server version>",
+    max_workers=MAX_WORKERS,
 )
 
 
@@ -80,241 +97,434 @@ TOOL_ARGS = []  # default arguments always passed to your tool.
 #  Pylint: https://github.com/microsoft/vscode-pylint/blob/main/bundled/tool
 
 
+# Diagnostics of recently linted documents keyed by (uri, hash of source).
+DIAGNOSTICS_CACHE_SIZE = 64
+_DIAGNOSTICS_CACHE: collections.OrderedDict[tuple[str, int], list[dict]] = (
+    collections.OrderedDict()
+)
+_DIAGNOSTICS_CACHE_LOCK = threading.Lock()
+
+# Number of diagnostics scanned between checks for publishing partial results,
+# and the minimum number of seconds between two partial publishes.
+DIAGNOSTICS_BATCH_SIZE = 500
+PUBLISH_INTERVAL = 0.2
+
+# Last published diagnostics of open documents, kept in sync with edits. Only kept
+# for documents with "\n" and "\r\n" line breaks, whose lines can be counted in C
+# and where no edit can join or split a CRLF.
+_DOCUMENT_DIAGNOSTICS: dict[str, list[dict]] = {}
+
+# Seconds to wait for further edits or saves before linting a document.
+DEBOUNCE_DELAY = 0.08
+_DEBOUNCE_TIMERS: dict[str, threading.Timer] = {}
+# Changes (or `None` for a full lint) since the results in _DOCUMENT_DIAGNOSTICS, the
+# source they produce and their generation, per document. An entry stays until its
+# results are stored, and every open, change, save or close replaces or removes it,
+# so results linted for an older generation are dropped.
+_PENDING_LINTS: dict[
+    str, tuple[list[lsp.TextDocumentContentChangeEvent] | None, str, int]
+] = {}
+_GENERATIONS = itertools.count()
+# Guards the timers, pending lints and stored diagnostics. It is only held for short
+# updates, never while linting.
+_LINT_LOCK = threading.Lock()
+
+
 @LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_OPEN)
 def did_open(params: lsp.DidOpenTextDocumentParams) -> None:
     """LSP handler for textDocument/didOpen request."""
     document = LSP_SERVER.workspace.get_document(params.text_document.uri)
-    diagnostics: list[lsp.Diagnostic] = _linting_helper(document)
-    LSP_SERVER.publish_diagnostics(document.uri, diagnostics)
+    # pygls keeps applying edits to the document, so a snapshot of its source is
+    # linted on the thread pool like any other pending full lint.
+    with _LINT_LOCK:
+        _PENDING_LINTS[document.uri] = (None, document.source, next(_GENERATIONS))
+    LSP_SERVER.thread_pool.apply_async(_run_pending_lint, (document.uri,))
+
+
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_CHANGE)
+def did_change(params: lsp.DidChangeTextDocumentParams) -> None:
+    """LSP handler for textDocument/didChange request."""
+    document = LSP_SERVER.workspace.get_document(params.text_document.uri)
+    _schedule_lint(document, params.content_changes)
 
 
 @LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_SAVE)
 def did_save(params: lsp.DidSaveTextDocumentParams) -> None:
     """LSP handler for textDocument/didSave request."""
     document = LSP_SERVER.workspace.get_document(params.text_document.uri)
-    diagnostics: list[lsp.Diagnostic] = _linting_helper(document)
-    LSP_SERVER.publish_diagnostics(document.uri, diagnostics)
+    _schedule_lint(document, None)
 
 
 @LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_CLOSE)
 def did_close(params: lsp.DidCloseTextDocumentParams) -> None:
     """LSP handler for textDocument/didClose request."""
     document = LSP_SERVER.workspace.get_document(params.text_document.uri)
-    # Publishing empty diagnostics to clear the entries for this file.
-    LSP_SERVER.publish_diagnostics(document.uri, [])
+    _clear_cached_diagnostics(document.uri)
+    with _LINT_LOCK:
+        timer = _DEBOUNCE_TIMERS.pop(document.uri, None)
+        if timer is not None:
+            timer.cancel()
+        _PENDING_LINTS.pop(document.uri, None)
+        _DOCUMENT_DIAGNOSTICS.pop(document.uri, None)
+        # Publishing empty diagnostics to clear the entries for this file.
+        _publish_diagnostics(document.uri, [])
+
+
+def _schedule_lint(
+    document: workspace.Document,
+    changes: Sequence[lsp.TextDocumentContentChangeEvent] | None,
+) -> None:
+    """Lints the document once no further change or save arrives for DEBOUNCE_DELAY.
 
+    Changes received in the meantime are accumulated so that only the lines they
+    touch are re-linted. Passing `None` for changes requests a full lint.
+    """
+    with _LINT_LOCK:
+        timer = _DEBOUNCE_TIMERS.pop(document.uri, None)
+        if timer is not None:
+            timer.cancel()
+
+        pending_changes, _, _ = _PENDING_LINTS.get(document.uri, ([], None, None))
+        if changes is None or pending_changes is None:
+            pending_changes = None
+        else:
+            pending_changes = pending_changes + list(changes)
+        # Keep the source matching the accumulated changes, the document itself
+        # may be edited again before the timer fires.
+        _PENDING_LINTS[document.uri] = (
+            pending_changes,
+            document.source,
+            next(_GENERATIONS),
+        )
 
-"""
-COMPUTER SYSTEMS SECURITY RELEVANT LINTING PORTION
+        timer = threading.Timer(DEBOUNCE_DELAY, _run_pending_lint, args=(document.uri,))
+        timer.daemon = True
+        _DEBOUNCE_TIMERS[document.uri] = timer
+        timer.start()
 
-Authors:
-Saad Rafiq, Ngoc Huynh, Anderson Le, Camryn Schaecher, Laiba Janat 
-"""
 
-# Unicode character dictionary declarations for searching
-
-# Bidirectional Unicode Characters
-BIDI_UNICODE_CHARS = {
-    "\u202A": "LRE",
-    "\u202B": "RLE",
-    "\u202D": "LRO",
-    "\u202E": "RLO",
-    "\u2066": "LRI",
-    "\u2067": "RLI",
-    "\u2068": "FSI",
-    "\u202C": "PDF",
-    "\u2069": "PDI",
-}
-
-# Inivsible Unicode Characters
-INVISIBLE_UNICODE_CHARS = {
-    "\u200B": "Zero-Width Space ZWSP)",
-    "\u200C": "Zero-Width Non-Joiner (ZWNJ)",
-    "\u200D": "Zero-Width Joiner (ZWJ)",
-    "\uFEFF": "Zero-Width Non-Breaking Space (ZWNBSP)",
-    "\u00AD": "Soft Hyphen (SHY)",
-    "\u200E": "Left-To-Right Mark (LTRM)",
-    "\u200F": "Right-To-Left Mark (RTLM)",
-    "\u2060": "Word Joiner (WJ)",
-    "\u2061": "Function Application (FAP)",
-    "\u2063": "Invisible Separator (IS)",
-    "\u2064": "Invisible Plus (IP)",
-    "\u2062": "Invisible Times (IT)"
-}
-
-# Homoglyphic Unicode Characters
-HOMOGLYPH_UNICODE_CHARS = {
-    # Greek Alphabet
-    "\u037F": "Greek Capital Letter Yot",
-    "\u0391": "Greek Capital Letter Alpha",
-    "\u0392": "Greek Capital Letter Beta",
-    "\u0395": "Greek Capital Letter Epsilon",
-    "\u0396": "Greek Capital Letter Zeta",
-    "\u0397": "Greek Capital Letter Eta",
-    "\u0399": "Greek Capital Letter Iota",
-    "\u039A": "Greek Capital Letter Kappa",
-    "\u039C": "Greek Capital Letter Mu",
-    "\u039D": "Greek Capital Letter Nu",
-    "\u039F": "Greek Capital Letter Omicron",
-    "\u03A1": "Greek Capital Letter Rho",
-    "\u03A4": "Greek Capital Letter Tau",
-    "\u03A5": "Greek Capital Letter Upsilon",
-    "\u03A7": "Greek Capital Letter Chi",
-    "\u03F2": "Greek Lunate Sigma Symbol",
-    "\u03F3": "Greek Letter Yot",
-    "\u03F9": "Greek Capital Lunate Sigma Symbol",
-    # Cyrillic Alphabet
-    "\u0405": "Cyrillic Capital Letter Dze",
-    "\u0406": "Cyrillic Capital Letter Byelorussian-Ukrainian I",
-    "\u0408": "Cyrillic Capital Letter Je",
-    "\u0410": "Cyrillic Capital Letter A",
-    "\u0412": "Cyrillic Capital Letter Ve",
-    "\u0415": "Cyrillic Capital Letter Ie",
-    "\u0417": "Cyrillic Capital Letter Ze",
-    "\u041D": "Cyrillic Capital Letter En",
-    "\u041E": "Cyrillic Capital Letter O",
-    "\u0420": "Cyrillic Capital Letter Er",
-    "\u0421": "Cyrillic Capital Letter Es",
-    "\u0422": "Cyrillic Capital Letter Te",
-    "\u0425": "Cyrillic Capital Letter Ha",
-    "\u04AE": "Cyrillic Capital Letter Straight U",
-    "\u04C0": "Cyrillic Letter Palochka",
-    "\u04CF": "Cyrillic Small Letter Palochka",
-}
-
-
-def _check_bidi_unicode(line: str, line_num: int) -> list[lsp.Diagnostic]:
-    """Checks for Bidirectional Unicode characters from the BIDI_UNICODE_CHARS dictionary
-    
-    function checks for Early Return Attack, Comment Out Attack, and any other Bidirectional characters
+def _run_pending_lint(uri: str) -> None:
+    """Lints the pending changes for the document and publishes the results."""
+    with _LINT_LOCK:
+        if _DEBOUNCE_TIMERS.get(uri) is threading.current_thread():
+            del _DEBOUNCE_TIMERS[uri]
+        pending = _PENDING_LINTS.get(uri)
+        diagnostics = _DOCUMENT_DIAGNOSTICS.get(uri)
+    if pending is None:
+        return
+
+    changes, source, generation = pending
+    if changes is not None and diagnostics is not None:
+        diagnostics = _update_line_diagnostics(source, diagnostics, changes)
+    else:
+        diagnostics = None
+    # The source only has "\n" and "\r\n" line breaks if the update succeeded.
+    can_update = diagnostics is not None
+    if diagnostics is None:
+        diagnostics = _get_diagnostics(workspace.Document(uri, source), generation)
+        if diagnostics is None:
+            return
+        can_update = scanner.has_newline_breaks_only(source)
+
+    with _LINT_LOCK:
+        # A change, save or close while linting made these results outdated, the
+        # lint scheduled for it starts again from the previously stored results.
+        if not _is_current(uri, generation):
+            return
+        del _PENDING_LINTS[uri]
+        if can_update:
+            _DOCUMENT_DIAGNOSTICS[uri] = diagnostics
+        else:
+            _DOCUMENT_DIAGNOSTICS.pop(uri, None)
+        _publish_diagnostics(uri, diagnostics)
+
+
+def _is_current(uri: str, generation: int) -> bool:
+    """Returns True if the generation is still pending for the document.
+
+    _LINT_LOCK must be held by the caller.
     """
-    diagnostics = []
-    # Iterate through each item in the dictionary searching the line for the character
-    for char, name in BIDI_UNICODE_CHARS.items():
-        index = line.find(char)
-
-        while index != -1:
-            # Identify the type of attack based on the context in the line
-            single_comment_index = line.find('#')
-            return_index = line.find("return")
-            multi_comment_index = line.find("\'\'\'")
-
-            # Create message for attack
-            if return_index != -1:
-                msg = f"Trojan Source Early Return Attack Detected.\nBidi Unicode Character {name} detected. An attacker has introduced a Bidirectional Unicode character to return your code early."
-            elif single_comment_index != -1 or multi_comment_index != -1:
-                msg = f"Trojan Source Comment Out Attack Detected.\nBidi Unicode Chracter {name} detected. An attacker has introduced a Bidirectional Unicode character to comment code and disturb logic."
-            else:
-                msg = f"Bidi Unicode Character {name} detected.\nAn attacker as introduced a Bidirectional Unicode Character to disturb code logic."
-
-            # Create diagnostic
-            position = lsp.Position(line=line_num, character=index)
-            diagnostic = lsp.Diagnostic(
-                range=lsp.Range(start=position, end=position),
-                message=msg,
-                severity=lsp.DiagnosticSeverity.Error,
-                source=TOOL_MODULE
-            )
-            diagnostics.append(diagnostic)
-            index = line.find(char, index + 1) 
+    pending = _PENDING_LINTS.get(uri)
+    return pending is not None and pending[2] == generation
+
+
+def _publish_diagnostics(uri: str, diagnostics: list[dict]) -> None:
+    """Sends textDocument/publishDiagnostics with diagnostics as plain JSON dicts."""
+    # `LSP_SERVER.publish_diagnostics` and `notify` expect lsprotocol objects for this
+    # method, so the generic notification is sent directly instead.
+    # pylint: disable-next=protected-access
+    LSP_SERVER.lsp._send_data(
+        JsonRPCNotification(
+            method=lsp.TEXT_DOCUMENT_PUBLISH_DIAGNOSTICS,
+            params={"uri": uri, "diagnostics": diagnostics},
+            jsonrpc="2.0",
+        )
+    )
 
-    # Return the list of diagnostics for this line
-    return diagnostics
 
+def _get_diagnostics(
+    document: workspace.Document, generation: int | None = None
+) -> list[dict] | None:
+    """Returns diagnostics for the document, re-linting only if its content changed.
 
-def _check_invisible_unicode_(line: str, line_num: int) -> list[lsp.Diagnostic]:
-    """Checks for invisible Unicode characters from the INVISIBLE_UNICODE_CHARS dictionary
-    
-    function checks for invisible attack type
+    If the generation of a pending lint is given, the scan stops and returns None
+    once that generation is superseded. Until then the diagnostics found so far are
+    published while a long scan is still running, at most once per PUBLISH_INTERVAL
+    and only once their number has doubled since the previous publish.
     """
-    diagnostics = []
-    # Iterate through each item in the dictionary searching the line for the character
-    for char, name in INVISIBLE_UNICODE_CHARS.items():
-        index = line.find(char)
-        while index != -1:
-            # if found create diagnostic with message
-            position = lsp.Position(line=line_num, character=index)
-            diagnostic = lsp.Diagnostic(
-                range=lsp.Range(start=position, end=position),
-                message=f"Trojan Source Invisible Attack Detected\nUnicode Character {name} detected. An attacker may be trying to disturb code logic.",
-                severity=lsp.DiagnosticSeverity.Warning,
-                source=TOOL_MODULE
-            )
-            diagnostics.append(diagnostic)
-            index = line.find(char, index + 1) 
+    key = (document.uri, hash(document.source))
+    with _DIAGNOSTICS_CACHE_LOCK:
+        diagnostics = _DIAGNOSTICS_CACHE.get(key)
+        if diagnostics is not None:
+            _DIAGNOSTICS_CACHE.move_to_end(key)
+            return diagnostics
 
-    # Return the list of diagnostics for this line
+    diagnostics = []
+    published = 0
+    last_publish = time.monotonic()
+    for batch in _linting_helper(document):
+        diagnostics.extend(batch)
+        if generation is None:
+            continue
+        # Every publish must carry the complete list known so far, so the list has to
+        # at least double between publishes to keep their total cost linear.
+        publish = (
+            len(diagnostics) >= 2 * published
+            and time.monotonic() - last_publish >= PUBLISH_INTERVAL
+        )
+        with _LINT_LOCK:
+            if not _is_current(document.uri, generation):
+                return None
+            if publish:
+                _publish_diagnostics(document.uri, diagnostics)
+        if publish:
+            published = len(diagnostics)
+            last_publish = time.monotonic()
+
+    with _DIAGNOSTICS_CACHE_LOCK:
+        _DIAGNOSTICS_CACHE[key] = diagnostics
+        if len(_DIAGNOSTICS_CACHE) > DIAGNOSTICS_CACHE_SIZE:
+            _DIAGNOSTICS_CACHE.popitem(last=False)
     return diagnostics
 
 
-def _check_homoglyph_unicode(line: str, line_num: int) -> list[lsp.Diagnostic]:
-    """Checks for Homoglyphic Unicode characters from the HOMOGLYPH_UNICODE_CHARS dictionary
-    
-    function checks for Homoglyph attack type
+def _clear_cached_diagnostics(uri: str) -> None:
+    """Drops all cached diagnostics for the given document."""
+    with _DIAGNOSTICS_CACHE_LOCK:
+        for key in [k for k in _DIAGNOSTICS_CACHE if k[0] == uri]:
+            del _DIAGNOSTICS_CACHE[key]
+
+
+def _bisect_line(diagnostics: list[dict], line: int, low: int = 0) -> int:
+    """Returns the index of the first diagnostic at or after the given line."""
+    high = len(diagnostics)
+    while low < high:
+        middle = (low + high) // 2
+        if diagnostics[middle]["range"]["start"]["line"] < line:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _move_diagnostic(diagnostic: dict, line: int) -> dict:
+    """Returns a copy of the diagnostic starting on the given line."""
+    start = diagnostic["range"]["start"]
+    end = diagnostic["range"]["end"]
+    return {
+        **diagnostic,
+        "range": {
+            "start": {"line": line, "character": start["character"]},
+            "end": {
+                "line": line + end["line"] - start["line"],
+                "character": end["character"],
+            },
+        },
+    }
+
+
+def _update_line_diagnostics(
+    source: str,
+    diagnostics: list[dict],
+    changes: Sequence[lsp.TextDocumentContentChangeEvent],
+) -> list[dict] | None:
+    """Re-lints only the lines touched by the changes already applied to the source.
+
+    Diagnostics after an edit are moved to their new lines, and only the lines the
+    changes produced are scanned again, found by offset in the new source. The
+    previous source must have had "\n" and "\r\n" line breaks only. Returns None if
+    the document has to be linted in full instead: a change replaces the full text
+    or adds other line breaks, or an edited line is past the end of the document.
     """
-    diagnostics = []
-    # Iterate through each item in the dictionary searching the line for the character
-    for char, name in HOMOGLYPH_UNICODE_CHARS.items():
-        index = line.find(char)
-        while index != -1:
-            # Create message
-            msg = f"Trojan Source Homoglyph Attack Detected. \nHomoglyphic Unicode character {name} detected. An attacker as introduced a Homoglyph Unicode Character to disturb code logic."
-
-            # Create diagnostic
-            position = lsp.Position(line=line_num, character=index)
-            diagnostic = lsp.Diagnostic(
-                range=lsp.Range(start=position, end=position),
-                message=msg,
-                severity=lsp.DiagnosticSeverity.Error,
-                source=TOOL_MODULE
-            )
-            diagnostics.append(diagnostic)
-            index = line.find(char, index + 1) 
+    if not all(_is_line_change(change) for change in changes):
+        return None
+    if source.isascii():
+        return []
+
+    # Line ranges (first, last) to scan again, in the coordinates after each change
+    stale: list[tuple[int, int]] = []
+    for change in changes:
+        start = change.range.start.line
+        end = change.range.end.line
+        added = change.text.count("\n")
+        shift = added - (end - start)
+
+        first = _bisect_line(diagnostics, start)
+        moved = diagnostics[_bisect_line(diagnostics, end + 1, first) :]
+        if shift:
+            moved = [
+                _move_diagnostic(d, d["range"]["start"]["line"] + shift) for d in moved
+            ]
+        diagnostics = diagnostics[:first] + moved
+        stale = _shift_line_ranges(stale, start, end, shift)
+
+    return _rescan_line_ranges(source, diagnostics, stale)
+
+
+def _shift_line_ranges(
+    line_ranges: list[tuple[int, int]], start: int, end: int, shift: int
+) -> list[tuple[int, int]]:
+    """Moves the sorted line ranges for lines start to end replaced by end + shift."""
+    low, high = start, end + shift
+    shifted = []
+    for first, last in line_ranges:
+        if last < start:
+            shifted.append((first, last))
+        elif first > end:
+            shifted.append((first + shift, last + shift))
+        else:
+            low = min(low, first)
+            high = max(high, last + shift)
+    return sorted(shifted + [(low, high)])
+
+
+def _rescan_line_ranges(
+    source: str, diagnostics: list[dict], line_ranges: list[tuple[int, int]]
+) -> list[dict] | None:
+    """Replaces the diagnostics on the sorted line ranges with a new scan of them."""
+    merged: list[dict] = []
+    index = 0
+    position = 0
+    line = 0
+    for first, last in line_ranges:
+        position = _skip_lines(source, position, first - line)
+        if position == -1:
+            return None
+        end = _skip_lines(source, position, last - first + 1)
+        if end == -1:
+            end = len(source)
+
+        next_index = _bisect_line(diagnostics, first, index)
+        merged += diagnostics[index:next_index]
+        merged += scanner.scan_text(source[position:end], first)
+        index = next_index
+        position = end
+        line = last + 1
+    merged += diagnostics[index:]
+    return merged
+
+
+def _is_line_change(change: lsp.TextDocumentContentChangeEvent) -> bool:
+    """Returns True if the change replaces a range with "\n" or "\r\n" lines."""
+    return isinstance(
+        change, lsp.TextDocumentContentChangeEvent_Type1
+    ) and scanner.has_newline_breaks_only(change.text)
+
+
+def _skip_lines(text: str, position: int, count: int) -> int:
+    """Returns the offset of the line count lines after the one at position.
+
+    The text must have "\n" and "\r\n" line breaks only. Returns -1 if the text
+    ends first. Line breaks are counted in windows that double in size and are then
+    halved, so the text is never split into lines.
+    """
+    low = position
+    size = 4096
+    while True:
+        high = min(low + size, len(text))
+        found = text.count("\n", low, high)
+        if found >= count or high == len(text):
+            break
+        count -= found
+        low = high
+        size *= 2
+
+    while high - low > 4096:
+        middle = (low + high) // 2
+        found = text.count("\n", low, middle)
+        if found >= count:
+            high = middle
+        else:
+            count -= found
+            low = middle
+
+    for _ in range(count):
+        low = text.find("\n", low, high) + 1
+        if low == 0:
+            return -1
+    return low
 
-    # Return the list of diagnostics for this line
-    return diagnostics
 
+"""
+COMPUTER SYSTEMS SECURITY RELEVANT LINTING PORTION
+
+Authors:
+Saad Rafiq, Ngoc Huynh, Anderson Le, Camryn Schaecher, Laiba Janat 
+"""
 
-def _linting_helper(document: workspace.Document) -> list[lsp.Diagnostic]:
-    # Diagnostics are the messages that appear they are objects that are put into a list and returned at the end here
-    diagnostics: list[lsp.Diagnostic] = []
-    # Get the lines of the document
-    lines = document.lines
-    # Lint each line
-    for i, line in enumerate(lines):
-        diagnostics.extend(_check_bidi_unicode(line, i))
-        diagnostics.extend(_check_invisible_unicode_(line, i))
-        diagnostics.extend(_check_homoglyph_unicode(line, i)) 
 
-    # Return the list
-    return diagnostics
+def _linting_helper(document: workspace.Document) -> Iterator[list[dict]]:
+    # Diagnostics are the messages that appear they are objects that are yielded here in batches
+    # so large documents can be reported while they are still being scanned
+    # The source is scanned as a whole, without splitting it into lines first
+    batch: list[dict] = []
+    for diagnostic in scanner.scan_text(document.source):
+        batch.append(diagnostic)
+        if len(batch) >= DIAGNOSTICS_BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
 
 
 """
 END OF RELEVANT LINTING PORTION
 """
 
+
 # **********************************************************
 # Required Language Server Initialization and Exit handlers.
 # **********************************************************
 @LSP_SERVER.feature(lsp.INITIALIZE)
 def initialize(params: lsp.InitializeParams) -> None:
     """LSP handler for initialize request."""
-    log_to_output(f"CWD Server: {os.getcwd()}")
+    if _LOG_ENABLED:
+        log_to_output(f"CWD Server: {os.getcwd()}")
 
-    paths = "\r\n   ".join(sys.path)
-    log_to_output(f"sys.path used to run Server:\r\n   {paths}")
+        paths = "\r\n   ".join(sys.path)
+        log_to_output(f"sys.path used to run Server:\r\n   {paths}")
 
     GLOBAL_SETTINGS.update(**params.initialization_options.get("globalSettings", {}))
 
     settings = params.initialization_options["settings"]
     _update_workspace_settings(settings)
-    log_to_output(
-        f"Settings used to run Server:\r\n{json.dumps(settings, indent=4, ensure_ascii=False)}\r\n"
-    )
-    log_to_output(
-        f"Global settings:\r\n{json.dumps(GLOBAL_SETTINGS, indent=4, ensure_ascii=False)}\r\n"
-    )
+    if _LOG_ENABLED:
+        log_to_output(
+            f"Settings used to run Server:\r\n{json.dumps(settings, indent=4, ensure_ascii=False)}\r\n"
+        )
+        log_to_output(
+            f"Global settings:\r\n{json.dumps(GLOBAL_SETTINGS, indent=4, ensure_ascii=False)}\r\n"
+        )
+
+
+@LSP_SERVER.feature(lsp.SET_TRACE)
+def set_trace(params: lsp.SetTraceParams) -> None:
+    """LSP handler for $/setTrace notification."""
+    global _LOG_ENABLED  # pylint: disable=global-statement
+
+    # The extension only traces "off" when neither log level shows anything.
+    _LOG_ENABLED = params.value != lsp.TraceValues.Off
 
 
 @LSP_SERVER.feature(lsp.EXIT)
@@ -339,34 +549,81 @@ def _get_global_defaults():
     }
 
 
+@dataclasses.dataclass(frozen=True)
+class WorkspaceSettings:  # pylint: disable=invalid-name,too-many-instance-attributes
+    """Settings used to run the tool for one workspace.
+
+    Instances are immutable, so they can be handed out without copying.
+    """
+
+    cwd: str
+    workspaceFS: str
+    workspace: str
+    path: Tuple[str, ...]
+    interpreter: Tuple[str, ...]
+    args: Tuple[str, ...]
+    importStrategy: str
+    showNotifications: str
+
+
+def _create_workspace_settings(values: Dict[str, Any]) -> WorkspaceSettings:
+    return WorkspaceSettings(
+        cwd=values["cwd"],
+        workspaceFS=values["workspaceFS"],
+        workspace=values["workspace"],
+        path=tuple(values["path"]),
+        interpreter=tuple(values["interpreter"]),
+        args=tuple(values["args"]),
+        importStrategy=values["importStrategy"],
+        showNotifications=values["showNotifications"],
+    )
+
+
 def _update_workspace_settings(settings):
+    global _WORKSPACES_FS  # pylint: disable=global-statement
+
+    _resolve_workspace_key.cache_clear()
     if not settings:
         key = os.getcwd()
-        WORKSPACE_SETTINGS[key] = {
-            "cwd": key,
-            "workspaceFS": key,
-            "workspace": uris.from_fs_path(key),
-            **_get_global_defaults(),
-        }
-        return
+        WORKSPACE_SETTINGS[key] = _create_workspace_settings(
+            {
+                "cwd": key,
+                "workspaceFS": key,
+                "workspace": uris.from_fs_path(key),
+                **_get_global_defaults(),
+            }
+        )
+    else:
+        for setting in settings:
+            key = uris.to_fs_path(setting["workspace"])
+            WORKSPACE_SETTINGS[key] = _create_workspace_settings(
+                {
+                    **_get_global_defaults(),
+                    "cwd": key,
+                    **setting,
+                    "workspaceFS": key,
+                }
+            )
 
-    for setting in settings:
-        key = uris.to_fs_path(setting["workspace"])
-        WORKSPACE_SETTINGS[key] = {
-            "cwd": key,
-            **setting,
-            "workspaceFS": key,
-        }
+    _WORKSPACES_FS = frozenset(s.workspaceFS for s in WORKSPACE_SETTINGS.values())
 
 
-def _get_settings_by_path(file_path: pathlib.Path):
-    workspaces = {s["workspaceFS"] for s in WORKSPACE_SETTINGS.values()}
+@functools.lru_cache(maxsize=1024)
+def _resolve_workspace_key(file_path: str, workspaces: frozenset[str]) -> str | None:
+    """Returns the closest workspace folder containing the given path, if any."""
+    document_workspace = pathlib.Path(file_path)
+    while document_workspace != document_workspace.parent:
+        if str(document_workspace) in workspaces:
+            return str(document_workspace)
+        document_workspace = document_workspace.parent
+
+    return None
 
-    while file_path != file_path.parent:
-        str_file_path = str(file_path)
-        if str_file_path in workspaces:
-            return WORKSPACE_SETTINGS[str_file_path]
-        file_path = file_path.parent
+
+def _get_settings_by_path(file_path: pathlib.Path):
+    key = _resolve_workspace_key(str(file_path), _WORKSPACES_FS)
+    if key is not None:
+        return WORKSPACE_SETTINGS[key]
 
     setting_values = list(WORKSPACE_SETTINGS.values())
     return setting_values[0]
@@ -374,14 +631,8 @@ def _get_settings_by_path(file_path: pathlib.Path):
 
 def _get_document_key(document: workspace.Document):
     if WORKSPACE_SETTINGS:
-        document_workspace = pathlib.Path(document.path)
-        workspaces = {s["workspaceFS"] for s in WORKSPACE_SETTINGS.values()}
-
         # Find workspace settings for the given file.
-        while document_workspace != document_workspace.parent:
-            if str(document_workspace) in workspaces:
-                return str(document_workspace)
-            document_workspace = document_workspace.parent
+        return _resolve_workspace_key(str(pathlib.Path(document.path)), _WORKSPACES_FS)
 
     return None
 
@@ -394,12 +645,14 @@ def _get_settings_by_document(document: workspace.Document | None):
     if key is None:
         # This is either a non-workspace file or there is no workspace.
         key = os.fspath(pathlib.Path(document.path).parent)
-        return {
-            "cwd": key,
-            "workspaceFS": key,
-            "workspace": uris.from_fs_path(key),
-            **_get_global_defaults(),
-        }
+        return _create_workspace_settings(
+            {
+                "cwd": key,
+                "workspaceFS": key,
+                "workspace": uris.from_fs_path(key),
+                **_get_global_defaults(),
+            }
+        )
 
     return WORKSPACE_SETTINGS[str(key)]
 
@@ -425,20 +678,19 @@ def _run_tool_on_document(
     if utils.is_stdlib_file(document.path):
         return None
 
-    # deep copy here to prevent accidentally updating global settings.
-    settings = copy.deepcopy(_get_settings_by_document(document))
+    settings = _get_settings_by_document(document)
 
-    code_workspace = settings["workspaceFS"]
-    cwd = settings["cwd"]
+    code_workspace = settings.workspaceFS
+    cwd = settings.cwd
 
     use_path = False
     use_rpc = False
-    if settings["path"]:
+    if settings.path:
         # 'path' setting takes priority over everything.
         use_path = True
-        argv = settings["path"]
-    elif settings["interpreter"] and not utils.is_current_interpreter(
-        settings["interpreter"][0]
+        argv = list(settings.path)
+    elif settings.interpreter and not utils.is_current_interpreter(
+        settings.interpreter[0]
     ):
         # If there is a different interpreter set use JSON-RPC to the subprocess
         # running under that interpreter.
@@ -449,7 +701,7 @@ def _run_tool_on_document(
         # process then run as module.
         argv = [TOOL_MODULE]
 
-    argv += TOOL_ARGS + settings["args"] + extra_args
+    argv += TOOL_ARGS + list(settings.args) + extra_args
 
     if use_stdin:
         # TODO: update these to pass the appropriate arguments to provide document contents
@@ -468,8 +720,7 @@ def _run_tool_on_document(
 
     if use_path:
         # This mode is used when running executables.
-        log_to_output(" ".join(argv))
-        log_to_output(f"CWD Server: {cwd}")
+        _log_command(argv, f"CWD Server: {cwd}")
         result = utils.run_path(
             argv=argv,
             use_stdin=use_stdin,
@@ -481,12 +732,11 @@ def _run_tool_on_document(
     elif use_rpc:
         # This mode is used if the interpreter running this server is different from
         # the interpreter used for running this server.
-        log_to_output(" ".join(settings["interpreter"] + ["-m"] + argv))
-        log_to_output(f"CWD Linter: {cwd}")
+        _log_command([*settings.interpreter, "-m", *argv], f"CWD Linter: {cwd}")
 
         result = jsonrpc.run_over_json_rpc(
             workspace=code_workspace,
-            interpreter=settings["interpreter"],
+            interpreter=settings.interpreter,
             module=TOOL_MODULE,
             argv=argv,
             use_stdin=use_stdin,
@@ -500,8 +750,7 @@ def _run_tool_on_document(
             log_to_output(result.stderr)
     else:
         # In this mode the tool is run as a module in the same process as the language server.
-        log_to_output(" ".join([sys.executable, "-m"] + argv))
-        log_to_output(f"CWD Linter: {cwd}")
+        _log_command([sys.executable, "-m"] + argv, f"CWD Linter: {cwd}")
         # This is needed to preserve sys.path, in cases where the tool modifies
         # sys.path and that might not work for this scenario next time around.
         with utils.substitute_attr(sys, "path", sys.path[:]):
@@ -530,20 +779,19 @@ def _run_tool_on_document(
 
 def _run_tool(extra_args: Sequence[str]) -> utils.RunResult:
     """Runs tool."""
-    # deep copy here to prevent accidentally updating global settings.
-    settings = copy.deepcopy(_get_settings_by_document(None))
+    settings = _get_settings_by_document(None)
 
-    code_workspace = settings["workspaceFS"]
-    cwd = settings["workspaceFS"]
+    code_workspace = settings.workspaceFS
+    cwd = settings.workspaceFS
 
     use_path = False
     use_rpc = False
-    if len(settings["path"]) > 0:
+    if len(settings.path) > 0:
         # 'path' setting takes priority over everything.
         use_path = True
-        argv = settings["path"]
-    elif len(settings["interpreter"]) > 0 and not utils.is_current_interpreter(
-        settings["interpreter"][0]
+        argv = list(settings.path)
+    elif len(settings.interpreter) > 0 and not utils.is_current_interpreter(
+        settings.interpreter[0]
     ):
         # If there is a different interpreter set use JSON-RPC to the subprocess
         # running under that interpreter.
@@ -558,19 +806,17 @@ def _run_tool(extra_args: Sequence[str]) -> utils.RunResult:
 
     if use_path:
         # This mode is used when running executables.
-        log_to_output(" ".join(argv))
-        log_to_output(f"CWD Server: {cwd}")
+        _log_command(argv, f"CWD Server: {cwd}")
         result = utils.run_path(argv=argv, use_stdin=True, cwd=cwd)
         if result.stderr:
             log_to_output(result.stderr)
     elif use_rpc:
         # This mode is used if the interpreter running this server is different from
         # the interpreter used for running this server.
-        log_to_output(" ".join(settings["interpreter"] + ["-m"] + argv))
-        log_to_output(f"CWD Linter: {cwd}")
+        _log_command([*settings.interpreter, "-m", *argv], f"CWD Linter: {cwd}")
         result = jsonrpc.run_over_json_rpc(
             workspace=code_workspace,
-            interpreter=settings["interpreter"],
+            interpreter=settings.interpreter,
             module=TOOL_MODULE,
             argv=argv,
             use_stdin=True,
@@ -583,8 +829,7 @@ def _run_tool(extra_args: Sequence[str]) -> utils.RunResult:
             log_to_output(result.stderr)
     else:
         # In this mode the tool is run as a module in the same process as the language server.
-        log_to_output(" ".join([sys.executable, "-m"] + argv))
-        log_to_output(f"CWD Linter: {cwd}")
+        _log_command([sys.executable, "-m"] + argv, f"CWD Linter: {cwd}")
         # This is needed to preserve sys.path, in cases where the tool modifies
         # sys.path and that might not work for this scenario next time around.
         with utils.substitute_attr(sys, "path", sys.path[:]):
@@ -613,9 +858,18 @@ def _run_tool(extra_args: Sequence[str]) -> utils.RunResult:
 def log_to_output(
     message: str, msg_type: lsp.MessageType = lsp.MessageType.Log
 ) -> None:
+    if msg_type == lsp.MessageType.Log and not _LOG_ENABLED:
+        return
     LSP_SERVER.show_message_log(message, msg_type)
 
 
+def _log_command(command: Sequence[str], cwd_message: str) -> None:
+    """Logs a command line and its working directory, if logging is enabled."""
+    if _LOG_ENABLED:
+        log_to_output(" ".join(command))
+        log_to_output(cwd_message)
+
+
 def log_error(message: str) -> None:
     LSP_SERVER.show_message_log(message, lsp.MessageType.Error)
     if os.getenv("LS_SHOW_NOTIFICATION", "off") in ["onError", "onWarning", "always"]:
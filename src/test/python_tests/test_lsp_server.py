@@ -0,0 +1,466 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""
+Tests for the scanning and diagnostics bookkeeping in lsp_server.
+"""
+
+import random
+import sys
+from threading import Event
+
+import pytest
+from hamcrest import assert_that, greater_than_or_equal_to, is_
+
+from .lsp_test_client import constants, defaults, session
+
+sys.path.insert(0, str(constants.PROJECT_ROOT / "bundled" / "tool"))
+
+# pylint: disable=wrong-import-position,import-error
+import lsp_scanner  # noqa: E402
+import lsp_server  # noqa: E402
+import lsprotocol.types as lsp  # noqa: E402
+from pygls import uris, workspace  # noqa: E402
+
+TEST_URI = "file:///test.py"
+TIMEOUT = 10  # 10 seconds
+
+
+def _count_lints(monkeypatch):
+    """Returns a list that gets an entry for every document linted by a scan."""
+    lints = []
+    linting_helper = lsp_server._linting_helper
+    monkeypatch.setattr(
+        lsp_server,
+        "_linting_helper",
+        lambda document: lints.append(document.uri) or linting_helper(document),
+    )
+    monkeypatch.setattr(
+        lsp_server, "_DIAGNOSTICS_CACHE", type(lsp_server._DIAGNOSTICS_CACHE)()
+    )
+    return lints
+
+
+def test_cached_diagnostics_are_not_rescanned(monkeypatch):
+    """Linting unchanged content again returns the cached list without a scan."""
+    lints = _count_lints(monkeypatch)
+    document = workspace.Document(TEST_URI, "a = '\u0410'\n")
+
+    first = lsp_server._get_diagnostics(document)
+    second = lsp_server._get_diagnostics(workspace.Document(TEST_URI, document.source))
+
+    assert_that(lints, is_([TEST_URI]))
+    assert_that(second, is_(first))
+
+
+def test_cache_evicts_least_recently_used(monkeypatch):
+    """Past DIAGNOSTICS_CACHE_SIZE entries, the least recently used one is dropped."""
+    lints = _count_lints(monkeypatch)
+    monkeypatch.setattr(lsp_server, "DIAGNOSTICS_CACHE_SIZE", 2)
+    documents = [workspace.Document(f"file:///{i}.py", "a = 1\n") for i in range(3)]
+
+    lsp_server._get_diagnostics(documents[0])
+    lsp_server._get_diagnostics(documents[1])
+    lsp_server._get_diagnostics(documents[0])
+    lsp_server._get_diagnostics(documents[2])
+
+    assert_that(lints, is_(["file:///0.py", "file:///1.py", "file:///2.py"]))
+    assert_that(
+        [uri for uri, _ in lsp_server._DIAGNOSTICS_CACHE],
+        is_(["file:///0.py", "file:///2.py"]),
+    )
+
+
+def test_did_close_drops_cached_diagnostics(monkeypatch):
+    """Closing a document drops every cached version of it and no other."""
+    _count_lints(monkeypatch)
+    monkeypatch.setattr(lsp_server, "_publish_diagnostics", lambda uri, _: None)
+    monkeypatch.setattr(
+        lsp_server.LSP_SERVER.lsp, "_workspace", workspace.Workspace(None)
+    )
+    for source in ["a = 1\n", "a = 2\n"]:
+        lsp_server._get_diagnostics(workspace.Document(TEST_URI, source))
+    lsp_server._get_diagnostics(workspace.Document("file:///other.py", "a = 1\n"))
+
+    lsp_server.did_close(
+        lsp.DidCloseTextDocumentParams(
+            text_document=lsp.TextDocumentIdentifier(uri=TEST_URI)
+        )
+    )
+
+    assert_that(
+        [uri for uri, _ in lsp_server._DIAGNOSTICS_CACHE],
+        is_(["file:///other.py"]),
+    )
+
+
+def test_partial_publishes_grow_geometrically(monkeypatch):
+    """Partial results are published early, each at least twice the previous one."""
+    source = "x = '\u0410'\n" * (lsp_server.DIAGNOSTICS_BATCH_SIZE * 20)
+    published = []
+    monkeypatch.setattr(lsp_server, "PUBLISH_INTERVAL", 0)
+    monkeypatch.setattr(
+        lsp_server,
+        "_publish_diagnostics",
+        lambda uri, diagnostics: published.append(len(diagnostics)),
+    )
+
+    lsp_server._PENDING_LINTS[TEST_URI] = (None, source, 1)
+    diagnostics = lsp_server._get_diagnostics(workspace.Document(TEST_URI, source), 1)
+    del lsp_server._PENDING_LINTS[TEST_URI]
+    lsp_server._clear_cached_diagnostics(TEST_URI)
+
+    assert_that(published[0], is_(lsp_server.DIAGNOSTICS_BATCH_SIZE))
+    for previous, current in zip(published, published[1:]):
+        assert_that(current, greater_than_or_equal_to(2 * previous))
+    assert_that(len(diagnostics), is_(lsp_server.DIAGNOSTICS_BATCH_SIZE * 20))
+    assert_that(
+        [d["range"]["start"]["line"] for d in diagnostics],
+        is_(list(range(lsp_server.DIAGNOSTICS_BATCH_SIZE * 20))),
+    )
+
+
+def test_superseded_scan_stops_publishing(monkeypatch):
+    """A scan whose pending lint was replaced returns None and publishes no more."""
+    source = "x = '\u0410'\n" * (lsp_server.DIAGNOSTICS_BATCH_SIZE * 20)
+    published = []
+
+    def _publish(uri, diagnostics):
+        published.append(len(diagnostics))
+        # A didClose removes the pending lint after the first publish.
+        lsp_server._PENDING_LINTS.pop(uri, None)
+
+    monkeypatch.setattr(lsp_server, "PUBLISH_INTERVAL", 0)
+    monkeypatch.setattr(lsp_server, "_publish_diagnostics", _publish)
+
+    lsp_server._PENDING_LINTS[TEST_URI] = (None, source, 1)
+    diagnostics = lsp_server._get_diagnostics(workspace.Document(TEST_URI, source), 1)
+
+    assert_that(diagnostics, is_(None))
+    assert_that(published, is_([lsp_server.DIAGNOSTICS_BATCH_SIZE]))
+
+
+def test_set_trace_toggles_logging(monkeypatch):
+    """Log messages follow the trace value sent after the server started."""
+    logged = []
+    monkeypatch.setattr(lsp_server, "_LOG_ENABLED", False)
+    monkeypatch.setattr(
+        lsp_server.LSP_SERVER, "show_message_log", lambda msg, _: logged.append(msg)
+    )
+
+    lsp_server.log_to_output("dropped")
+    lsp_server.set_trace(lsp.SetTraceParams(value=lsp.TraceValues.Messages))
+    lsp_server.log_to_output("shown")
+    lsp_server.set_trace(lsp.SetTraceParams(value=lsp.TraceValues.Off))
+    lsp_server.log_to_output("dropped")
+
+    assert_that(logged, is_(["shown"]))
+
+
+def test_burst_of_changes_lints_once(monkeypatch):
+    """Changes and saves within DEBOUNCE_DELAY are linted and published once."""
+    published = []
+    full_lints = []
+    get_diagnostics = lsp_server._get_diagnostics
+    monkeypatch.setattr(
+        lsp_server,
+        "_publish_diagnostics",
+        lambda uri, diagnostics: published.append(diagnostics),
+    )
+    monkeypatch.setattr(
+        lsp_server,
+        "_get_diagnostics",
+        lambda *args: full_lints.append(args) or get_diagnostics(*args),
+    )
+
+    document = workspace.Document(TEST_URI, "a = 1\n")
+    lsp_server._DOCUMENT_DIAGNOSTICS[TEST_URI] = []
+    for i, text in enumerate(["\u0410", "\u200b", "\u202e"]):
+        change = _change(0, 4 + i, 0, 4 + i, text)
+        document.apply_change(change)
+        lsp_server._schedule_lint(document, [change])
+        if i == 1:
+            lsp_server._schedule_lint(document, None)
+
+    lsp_server._DEBOUNCE_TIMERS[TEST_URI].join(TIMEOUT)
+    lsp_server._DOCUMENT_DIAGNOSTICS.pop(TEST_URI)
+    lsp_server._clear_cached_diagnostics(TEST_URI)
+
+    assert_that(len(full_lints), is_(1))
+    assert_that(published, is_([list(lsp_scanner.scan_text(document.source))]))
+
+
+def _use_workspace_settings(monkeypatch, global_settings, settings):
+    monkeypatch.setattr(lsp_server, "GLOBAL_SETTINGS", global_settings)
+    monkeypatch.setattr(lsp_server, "WORKSPACE_SETTINGS", {})
+    monkeypatch.setattr(lsp_server, "_WORKSPACES_FS", frozenset())
+    lsp_server._update_workspace_settings(settings)
+
+
+def test_workspace_settings_default_to_global_settings(monkeypatch):
+    """Settings a workspace entry leaves out are taken from the global settings."""
+    workspace_path = str(constants.PROJECT_ROOT)
+    workspace_uri = uris.from_fs_path(workspace_path)
+    _use_workspace_settings(
+        monkeypatch,
+        {"path": ["tool"], "interpreter": ["python"], "args": ["--global"]},
+        [{"workspace": workspace_uri, "importStrategy": "fromEnvironment"}],
+    )
+
+    assert_that(
+        lsp_server.WORKSPACE_SETTINGS[workspace_path],
+        is_(
+            lsp_server.WorkspaceSettings(
+                cwd=workspace_path,
+                workspaceFS=workspace_path,
+                workspace=workspace_uri,
+                path=("tool",),
+                interpreter=("python",),
+                args=("--global",),
+                importStrategy="fromEnvironment",
+                showNotifications="off",
+            )
+        ),
+    )
+
+
+def test_run_tool_builds_argv_from_settings(monkeypatch):
+    """The tool runs with a new argv list each time and the settings stay as they are."""
+    workspace_path = str(constants.PROJECT_ROOT)
+    _use_workspace_settings(
+        monkeypatch,
+        {},
+        [
+            {
+                "workspace": uris.from_fs_path(workspace_path),
+                "path": ["tool"],
+                "args": ["--workspace"],
+            }
+        ],
+    )
+    settings = lsp_server.WORKSPACE_SETTINGS[workspace_path]
+    runs = []
+
+    def _run_path(argv, **_):
+        runs.append(argv)
+        return lsp_server.utils.RunResult("", "")
+
+    monkeypatch.setattr(lsp_server.utils, "run_path", _run_path)
+    monkeypatch.setattr(lsp_server, "_LOG_ENABLED", False)
+    document = workspace.Document(
+        uris.from_fs_path(str(constants.TEST_DATA / "sample1" / "sample.py")), "a = 1\n"
+    )
+
+    for _ in range(2):
+        lsp_server._run_tool_on_document(document)
+        lsp_server._run_tool(["--version"])
+
+    document_argv = ["tool", *lsp_server.TOOL_ARGS, "--workspace", document.path]
+    assert_that(runs, is_([document_argv, ["tool", "--version"]] * 2))
+    assert_that(lsp_server.WORKSPACE_SETTINGS[workspace_path], is_(settings))
+    assert_that(settings.path, is_(("tool",)))
+    assert_that(settings.args, is_(("--workspace",)))
+
+
+def _change(start_line, start_char, end_line, end_char, text):
+    return lsp.TextDocumentContentChangeEvent_Type1(
+        range=lsp.Range(
+            start=lsp.Position(line=start_line, character=start_char),
+            end=lsp.Position(line=end_line, character=end_char),
+        ),
+        text=text,
+    )
+
+
+def _full_lint(document):
+    return list(lsp_scanner.scan_text(document.source))
+
+
+def _apply_changes(source, changes):
+    """Returns the diagnostics updated for the changes and after a full lint."""
+    document = workspace.Document(TEST_URI, source)
+    diagnostics = _full_lint(document)
+    for change in changes:
+        document.apply_change(change)
+    updated = lsp_server._update_line_diagnostics(document.source, diagnostics, changes)
+    return updated, _full_lint(document)
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        pytest.param([_change(1, 4, 1, 4, "\u200b")], id="single-line"),
+        pytest.param([_change(1, 0, 1, 0, "y = '\u0391'\n\n")], id="insert-lines"),
+        pytest.param([_change(0, 3, 2, 1, "")], id="delete-lines"),
+        pytest.param(
+            [
+                _change(3, 0, 3, 0, "# \u202e\n"),
+                _change(0, 0, 1, 0, ""),
+                _change(2, 1, 2, 1, "\u0410\n\u200d"),
+            ],
+            id="several-changes",
+        ),
+    ],
+)
+def test_update_line_diagnostics(changes):
+    """Re-linting only the edited lines matches a full lint."""
+    source = "a = '\u0410'\nb = 1\nc = '\u200b'\nreturn '\u202e'\n"
+
+    updated, expected = _apply_changes(source, changes)
+
+    assert_that(updated, is_(expected))
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        pytest.param(
+            [lsp.TextDocumentContentChangeEvent_Type2(text="\u0391\n\u200b\n")],
+            id="full-text",
+        ),
+        pytest.param([_change(0, 0, 0, 0, "\u0391\r\u200b")], id="lone-cr"),
+        pytest.param([_change(9, 0, 9, 0, "\u0391")], id="past-end"),
+    ],
+)
+def test_update_line_diagnostics_falls_back(changes):
+    """Changes that can't be applied line by line ask for a full lint."""
+    source = "a = '\u0410'\nb = 1\n"
+
+    updated, _ = _apply_changes(source, changes)
+
+    assert_that(updated, is_(None))
+
+
+def test_update_line_diagnostics_random_edits():
+    """Random sequences of edits give the same results as a full lint."""
+    rand = random.Random(0)
+    alphabet = ["a", " ", "#", "\n", "\r\n", "\u0410", "\u202e", "\u200b"]
+    for _ in range(300):
+        source = "".join(rand.choice(alphabet) for _ in range(60))
+        document = workspace.Document(TEST_URI, source)
+        changes = []
+        for _ in range(rand.randint(1, 4)):
+            lines = document.lines or [""]
+            start = rand.randrange(len(lines))
+            end = rand.randint(start, len(lines) - 1)
+            change = _change(
+                start,
+                rand.randint(0, len(lines[start].rstrip("\r\n"))),
+                end,
+                len(lines[end].rstrip("\r\n")),
+                "".join(rand.choice(alphabet) for _ in range(rand.randint(0, 6))),
+            )
+            document.apply_change(change)
+            changes.append(change)
+
+        updated, expected = _apply_changes(source, changes)
+
+        assert_that(updated, is_(expected))
+
+
+def test_did_change_publishes_updated_diagnostics():
+    """Edits sent over LSP publish the diagnostics of the edited document."""
+    expected = [{"line": 0, "character": 5}, {"line": 1, "character": 2}]
+
+    actual = []
+    with session.LspSession() as ls_session:
+        ls_session.initialize(defaults.VSCODE_DEFAULT_INITIALIZE)
+
+        done = Event()
+
+        def _handler(params):
+            nonlocal actual
+            actual = [d["range"]["start"] for d in params["diagnostics"]]
+            if actual == expected:
+                done.set()
+
+        ls_session.set_notification_callback(session.PUBLISH_DIAGNOSTICS, _handler)
+
+        ls_session.notify_did_open(
+            {
+                "textDocument": {
+                    "uri": TEST_URI,
+                    "languageId": "python",
+                    "version": 1,
+                    "text": "a = '\u0410'\nb = 1\n",
+                }
+            }
+        )
+        ls_session.notify_did_change(
+            {
+                "textDocument": {"uri": TEST_URI, "version": 2},
+                "contentChanges": [
+                    {
+                        "range": {
+                            "start": {"line": 1, "character": 0},
+                            "end": {"line": 1, "character": 0},
+                        },
+                        "text": "# \u202e\n",
+                    }
+                ],
+            }
+        )
+
+        done.wait(TIMEOUT)
+
+    assert_that(actual, is_(expected))
+
+
+@pytest.mark.parametrize(
+    "line_break",
+    [
+        "\n",
+        "\r\n",
+        "\r",
+        "\v",
+        "\f",
+        "\x1c",
+        "\x1d",
+        "\x1e",
+        "\x85",
+        "\u2028",
+        "\u2029",
+    ],
+)
+def test_scan_text_positions(line_break):
+    """Diagnostics land on the lines str.splitlines() gives for each line break."""
+    rlo = "\u202e"
+    lines = ["a = '\u0410'", f"# {rlo} x", f"return '{rlo}'", f"x{rlo}"]
+
+    actual = [
+        (d["range"]["start"]["line"], d["range"]["start"]["character"], d["message"])
+        for d in lsp_scanner.scan_text(line_break.join(lines))
+    ]
+
+    assert_that(
+        actual,
+        is_(
+            [
+                (0, 5, lsp_scanner._HOMOGLYPH_MSGS["\u0410"]),
+                (1, 2, lsp_scanner._BIDI_MSGS[rlo][0]),
+                (2, 8, lsp_scanner._BIDI_MSGS[rlo][1]),
+                (3, 1, lsp_scanner._BIDI_MSGS[rlo][2]),
+            ]
+        ),
+    )
+
+
+def test_scan_text_mixed_line_breaks():
+    """A lone carriage return among line feeds still starts a new line."""
+    rlo = "\u202e"
+    source = f"x{rlo}\r\ny\rz{rlo}\n'''{rlo}"
+
+    actual = [
+        (d["range"]["start"]["line"], d["range"]["start"]["character"], d["message"])
+        for d in lsp_scanner.scan_text(source, first_line=4)
+    ]
+
+    assert_that(
+        actual,
+        is_(
+            [
+                (4, 1, lsp_scanner._BIDI_MSGS[rlo][2]),
+                (6, 1, lsp_scanner._BIDI_MSGS[rlo][2]),
+                (7, 3, lsp_scanner._BIDI_MSGS[rlo][0]),
+            ]
+        ),
+    )